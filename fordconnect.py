@@ -2,6 +2,7 @@
 import logging
 from datetime import timedelta, datetime
 
+import orjson
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -10,6 +11,7 @@ postmanHeaders = {
     "Accept": "*/*",
     "User-Agent": "PostmanRuntime/7.42.0",
     "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
 }
 
 apiHeaders = {
@@ -37,14 +39,17 @@ class FordConnect:
         self.refresh_token = params["refresh_token"]
         self.refresh_interval = timedelta(minutes=params["refresh_interval_mins"])
         self.tokens = None
+        self.tokens_expire_time = datetime.now()
+        self.auth_headers = None
 
-        adapter = HTTPAdapter(max_retries=Retry(connect=3, backoff_factor=0.5))
+        # keep a small pool of warm connections to login.ford.com / api.mps.ford.com
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(connect=3, backoff_factor=0.5))
         self.session = requests.session()
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
 
     def is_token_valid(self) -> bool:
-        return self.tokens is not None and datetime.fromtimestamp(self.tokens['expires_on']) > datetime.now()
+        return self.tokens is not None and self.tokens_expire_time > datetime.now()
 
     def refresh_tokens(self):
         if not self.is_token_valid():
@@ -58,28 +63,25 @@ class FordConnect:
 
             response = self.session.post(url=OAUTH_URL, headers=postmanHeaders, data=data)
             response.raise_for_status()
-            self.tokens = response.json()
+            self.tokens = orjson.loads(response.content)
+            # refresh 30 seconds ahead of expiry; keep the rotated refresh token for the next refresh
+            self.tokens_expire_time = datetime.now() + timedelta(seconds=int(self.tokens.get("expires_in", 1800)) - 30)
+            self.refresh_token = self.tokens.get("refresh_token", self.refresh_token)
+            self.auth_headers = {
+                **apiHeaders,
+                "Authorization": "Bearer " + self.tokens["access_token"]
+            }
 
     def vehicle_ids(self):
         self.refresh_tokens()
 
-        headers = {
-            **apiHeaders,
-            "Authorization": "Bearer " + self.tokens["access_token"]
-        }
-
-        response = self.session.get(url=API_GET_VEHICLES, headers=headers)
+        response = self.session.get(url=API_GET_VEHICLES, headers=self.auth_headers)
         response.raise_for_status()
-        return response.json()["vehicles"]
+        return orjson.loads(response.content)["vehicles"]
 
     def vehicle_info(self, vehicle_id: str):
         self.refresh_tokens()
 
-        headers = {
-            **apiHeaders,
-            "Authorization": "Bearer " + self.tokens["access_token"]
-        }
-
-        response = self.session.get(url=API_GET_VEHICLES + "/" + vehicle_id, headers=headers)
+        response = self.session.get(url=API_GET_VEHICLES + "/" + vehicle_id, headers=self.auth_headers)
         response.raise_for_status()
-        return response.json()["vehicle"]
+        return orjson.loads(response.content)["vehicle"]
@@ -2,68 +2,225 @@ import json
 import logging
 import logging.config
 import os
-from datetime import datetime, timedelta
-from time import sleep
-
+import random
+import sched
+import statistics
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from enum import Enum
+from time import sleep, monotonic
+from zoneinfo import ZoneInfo
+
+import orjson
 import pyemvue
 import pypowerwall
-from dateutil import parser, tz
+import requests
 from suntime import Sun
 
 from fordconnect import FordConnect
 
 
+class State(Enum):
+    IDLE = "idle"
+    CHARGING = "charging"
+    WAIT_PROTECTION = "wait_protection"
+    STOP_PENDING = "stop_pending"
+    STOPPED = "stopped"
+
+
+def client_sessions(*clients) -> list:
+    """
+    return the requests.Session the client libraries hold, left as configured by the libraries
+    """
+    sessions = []
+    for client in clients:
+        for name in ("session", "_session"):
+            session = getattr(client, name, None)
+            if isinstance(session, requests.Session):
+                sessions.append(session)
+    return sessions
+
+
+class CacheEntry:
+    """
+    cached value of a remote endpoint, fresh for ttl seconds and served while refreshing in background
+    until stale_ttl seconds, after which get() blocks on a new value
+    """
+
+    def __init__(self, fetcher, ttl: float, stale_ttl: float = None, executor: ThreadPoolExecutor = None):
+        self.logger = logging.getLogger(__name__)
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.stale_ttl = ttl if stale_ttl is None else stale_ttl
+        self.executor = executor
+        self.value = None
+        self.fetched_at = float("-inf")
+        self.future = None
+        self.lock = threading.Lock()
+
+    def age(self) -> float:
+        return monotonic() - self.fetched_at
+
+    def set(self, value):
+        self.value, self.fetched_at = value, monotonic()
+
+    def refresh(self):
+        # never run two fetches of the same endpoint at once
+        if self.lock.acquire(blocking=False):
+            try:
+                self.set(self.fetcher())
+            finally:
+                self.lock.release()
+
+    def refresh_async(self):
+        if self.future is None or self.future.done():
+            self.future = self.executor.submit(self._refresh_logged)
+
+    def _refresh_logged(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self.logger.exception(e)
+
+    def get(self):
+        age = self.age()
+        if age >= self.stale_ttl:
+            if self.future is not None and not self.future.done():
+                self.future.result()
+            else:
+                self.refresh()
+        elif age >= self.ttl and self.executor is not None:
+            self.refresh_async()
+        return self.value
+
+
 class SolarHome:
     def __init__(self, params: dict) -> None:
         self.logger = logging.getLogger(__name__)
 
+        # overlap independent Powerwall / Emporia / Ford requests
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
         # set start and stop time
-        self.time_zone = tz.gettz("America/Los_Angeles")
-        self.sunrise, self.sunset = self.sunrise_sunset()
-        self.nem_peak_hour = parser.parse("15:00").astimezone(self.time_zone)
-        self.excessive_ratio = params.get("excessive_ratio") or 0.98
-        self.max_soc_on_grid = params.get("max_soc_on_grid") or 60
-        self.api_refresh_interval = timedelta(seconds=60)
+        self.time_zone = ZoneInfo("America/Los_Angeles")
+        # excessive solar is never enough this close to sunrise / sunset
+        self.solar_margin = timedelta(minutes=20)
+        self.update_solar_day(datetime.now(tz=self.time_zone))
+        self.excessive_ratio = params.get("excessive_ratio", 0.98)
+        self.max_soc_on_grid = params.get("max_soc_on_grid", 60)
 
         # ford ev
         self.ford = FordConnect(params["ford"])
-        self.vehicle_soc = self.max_soc_on_grid
-        self.vehicle_soc_update_time = datetime.today().astimezone(self.time_zone) - timedelta(days=1)
-        self.vehicle_id = None
+        self.ford_state_file = "ford_state.json"
+        self.vehicle_id = self.load_vehicle_id()
+        # SOC changes hour to hour, kept fresh by soc_tick
+        self.soc = CacheEntry(self.fetch_ev_soc, ttl=self.ford.refresh_interval.total_seconds(), executor=self.executor)
 
         # powerwall
-        self.powerwall_host = params["powerwall"]["host"]
-        self.powerwall_user = params["powerwall"]["user"]
-        self.powerwall_password = params["powerwall"]["password"]
+        self.powerwall_host = str(params["powerwall"]["host"])
+        self.powerwall_user = str(params["powerwall"]["user"])
+        self.powerwall_password = str(params["powerwall"]["password"])
         self.powerwall = None
+        self.powerwall_sessions = []
+        self.battery_power = 0
+        self.powerwall_login_backoff = 1
+        self.powerwall_next_login = float("-inf")
+        # power changes second to second, stale readings are served while refreshing
+        self.power = CacheEntry(self.fetch_power, ttl=params["powerwall"].get("fresh_ttl", 10),
+                                stale_ttl=params["powerwall"].get("stale_ttl", 30), executor=self.executor)
 
         # emporia
         self.emporia_user = str(params["emporia"]["user"])
         self.emporia_password = str(params["emporia"]["password"])
         self.emporia_token_file = "keys.json"
         self.emporia = pyemvue.PyEmVue()
-        self.evse_refresh_time = datetime.today().astimezone(self.time_zone) - timedelta(days=1)
+        # charger status changes minute to minute, writes replace the cached status
+        self.charger = CacheEntry(self.fetch_charger, ttl=60, executor=self.executor)
+        self.charger_checked = False
         self.evse = None
         self.emporia_vehicle = None
 
-        self.min_excessive_solar = int(6 * 240)
+        # charger limits: amps at 240v
+        self.voltage = 240
+        self.min_charging_rate, self.max_charging_rate = 6, 40
+        self.charging_rate_per_watt = self.excessive_ratio / self.voltage
+        self.min_excessive_solar = self.min_charging_rate * self.voltage
         self.min_charging_state_change_interval = timedelta(minutes=5)
-        self.last_charging_state_change = datetime.now(tz=self.time_zone) - self.min_charging_state_change_interval
-
-    def sunrise_sunset(self):
+        # internal timestamps are time.monotonic() seconds
+        self.last_charging_state_change = monotonic() - self.min_charging_state_change_interval.total_seconds()
+        self.min_charging_rate_delta = 2
+        self.min_charger_update_interval = timedelta(seconds=30)
+        self.last_charger_update = monotonic() - self.min_charger_update_interval.total_seconds()
+        self.pending_charging_rate = None
+        self.pending_rate_update = None
+
+        # http sessions to close on exit
+        self.sessions = {self.ford.session}
+
+        # scheduler: poll interval backs off while nothing changes
+        self.scheduler = sched.scheduler(monotonic, sleep)
+        self.state = State.IDLE
+        self.charging = None
+        self.next_tick = None
+        self.poll_intervals = (15, 60, 300)
+        self.poll_level = 0
+        self.excessive_hysteresis = 200
+        self.last_excessive = None
+        self.solar_charging = False
+        # poll faster while solar is volatile: interval / (1 + stdev / volatility_scale)
+        self.excessive_samples = deque(maxlen=10)
+        self.volatility_scale = 500
+        self.min_poll_interval = 5
+        self.fail_count = 0
+        self.max_fail_backoff = 300
+        self.prefetch_lead = 5
+
+    def sunrise_sunset(self, day: date):
         sun = Sun(37.32, -122.03)
-        sunrise = sun.get_sunrise_time(time_zone=self.time_zone)
-        sunset = sun.get_sunset_time(time_zone=self.time_zone)
-        # temp fix for sunset is yesterday
-        sunset = datetime.combine(sunrise, sunset.time(), tzinfo=self.time_zone)
+        # suntime 1.3.x needs a datetime, a plain date has no hour
+        noon = datetime.combine(day, time(12), tzinfo=self.time_zone)
+        sunrise = sun.get_sunrise_time(noon, time_zone=self.time_zone)
+        sunset = sun.get_sunset_time(noon, time_zone=self.time_zone)
+        # suntime 1.3.x computes sunset on the UTC date, the previous local evening west of Greenwich,
+        # 1.4.x already corrects it and never takes this branch
+        if sunset < sunrise:
+            sunset += timedelta(days=1)
         return sunrise, sunset
 
+    def update_solar_day(self, now: datetime):
+        # computed once per run, run() stops at sunset
+        self.sunrise, self.sunset = self.sunrise_sunset(now.date())
+        self.nem_peak_hour = datetime.combine(now.date(), time(15), tzinfo=self.time_zone)
+        # monotonic deadlines, immune to clock steps and cheap to compare every tick, past times stay in the past
+        start = monotonic()
+        (self.sunrise_deadline, self.nem_peak_hour_deadline, self.sunset_deadline,
+         self.solar_start_deadline, self.solar_end_deadline) = (
+            start + (t - now).total_seconds() for t in (
+                self.sunrise, self.nem_peak_hour, self.sunset,
+                self.sunrise + self.solar_margin, self.sunset - self.solar_margin))
+
+    def load_vehicle_id(self):
+        if os.path.exists(self.ford_state_file):
+            try:
+                with open(self.ford_state_file) as f:
+                    return orjson.loads(f.read())["vehicle_id"]
+            except Exception as e:
+                os.remove(self.ford_state_file)
+                self.logger.exception(e)
+        return None
+
+    def save_vehicle_id(self):
+        with open(self.ford_state_file, "w") as f:
+            json.dump({"vehicle_id": self.vehicle_id}, f)
+
     def login_emporia(self) -> bool:
         loggedin = False
         if os.path.exists(self.emporia_token_file):
             try:
                 with open(self.emporia_token_file) as f:
-                    token = json.load(f)
+                    token = orjson.loads(f.read())
                     loggedin = self.emporia.login(
                         id_token=token["id_token"],
                         access_token=token["access_token"],
@@ -80,58 +237,90 @@ class SolarHome:
                 password=self.emporia_password,
                 token_storage_file=self.emporia_token_file,
             )
-        self.logger.info("Logged into Emporia EVSE: %s" % loggedin)
+        self.logger.info("Logged into Emporia EVSE: %s", loggedin)
         return loggedin
 
     def login_powerwall(self) -> bool:
-        connected = True
-        if not self.powerwall or not self.powerwall.is_connected():
-            self.powerwall = pypowerwall.Powerwall(
-                host=self.powerwall_host,
-                email=self.powerwall_user,
-                password=self.powerwall_password
-            )
-            connected = self.powerwall.is_connected()
-            self.logger.info(f"Connect to Tesla Powerwall: {connected}")
+        if self.powerwall and self.powerwall.is_connected():
+            return True
+        if monotonic() < self.powerwall_next_login:
+            return False
+
+        # the replaced client's connections are never used again
+        for session in self.powerwall_sessions:
+            session.close()
+            self.sessions.discard(session)
+        self.powerwall = pypowerwall.Powerwall(
+            host=self.powerwall_host,
+            email=self.powerwall_user,
+            password=self.powerwall_password
+        )
+        self.powerwall_sessions = client_sessions(self.powerwall, getattr(self.powerwall, "client", None))
+        self.sessions.update(self.powerwall_sessions)
+        connected = self.powerwall.is_connected()
+        if connected:
+            self.powerwall_login_backoff = 1
+        else:
+            # back off with jitter so a throttling gateway is not hammered with logins
+            self.powerwall_login_backoff = min(self.powerwall_login_backoff * 2, 300)
+            self.powerwall_next_login = monotonic() + self.powerwall_login_backoff * random.uniform(1, 1.25)
+        self.logger.info("Connect to Tesla Powerwall: %s", connected)
         return connected
 
     def available_solar(self) -> int:
         # get stats from powerwall
-        if self.login_powerwall():
-            power = self.powerwall.power()
-            self.powerwall.solar = power["solar"]
-            self.powerwall.battery = power["battery"]
-            self.powerwall.home = power["load"]
-
-        else:
-            self.powerwall.solar = 0
-            self.powerwall.battery = 0
-            self.powerwall.home = 0
+        power = self.power.get()
+        if power is None:
+            self.logger.debug("Powerwall is not connected, no available solar.")
+            self.battery_power = 0
+            return 0
+        solar, battery, home = power["solar"], power["battery"], power["load"]
+        self.battery_power = battery
         # calculate available solar
-        available = self.powerwall.solar - self.powerwall.home - abs(self.powerwall.battery)
+        available = solar - home - abs(battery)
         self.logger.debug(
-            f"Available solar: {available:,.0f}w "
-            f"[Solar: {self.powerwall.solar:,.0f}w; "
-            f"Home: {self.powerwall.home:,.0f}w; "
-            f"Battery: {self.powerwall.battery:,.0f}w]")
+            "Available solar: %.0fw [Solar: %.0fw; Home: %.0fw; Battery: %.0fw]", available, solar, home, battery)
         return int(available)
 
+    def fetch_power(self):
+        return self.powerwall.power() if self.login_powerwall() else None
+
     def solar_charge(self) -> bool:
         """
         return True if charging on excessive solar, else False
         """
+        if not self.solar_start_deadline <= monotonic() < self.solar_end_deadline:
+            self.logger.debug("Too close to sunrise or sunset for excessive solar.")
+            self.stop_charger()
+            return False
+
+        # read powerwall while refreshing charger status
+        solar = self.executor.submit(self.available_solar)
         self.refresh_charger_status()
+        available = solar.result()
         if not self.is_car_connected():
-            self.logger.debug(f"EV charger is not plugged in: {self.evse.icon}.")
+            self.logger.debug("EV charger is not plugged in: %s.", self.evse.icon)
+            self.set_state(State.IDLE)
             return self.evse.charger_on
 
-        excessive = self.available_solar() + self.evse.charger_on * self.evse.charging_rate * 240
-        if excessive > self.min_excessive_solar:
-            charge_rate = int(max(min(excessive * self.excessive_ratio / 240, 40), 6))
+        excessive = available + self.evse.charger_on * self.evse.charging_rate * self.voltage
+        self.excessive_samples.append(excessive)
+        stable = self.last_excessive is not None and abs(excessive - self.last_excessive) < self.excessive_hysteresis
+        if not stable:
+            self.last_excessive = excessive
+            self.poll_level = 0
+        # only solar charging is tracked by excessive, a grid charge cancels out of it
+        if stable and self.solar_charging and self.state == State.CHARGING and excessive > self.min_excessive_solar:
+            self.logger.debug(
+                "Excessive solar is stable at %dw, keep charging at %dA", excessive, self.evse.charging_rate)
+            self.poll_level = min(self.poll_level + 1, len(self.poll_intervals) - 1)
+        elif excessive > self.min_excessive_solar:
+            charge_rate = int(excessive * self.charging_rate_per_watt)
             if self.set_charger(charge_rate):
-                self.logger.info(f"Charging at {self.evse.charging_rate}A with excessive solar {excessive:,}w")
+                self.solar_charging = True
+                self.logger.info("Charging at %dA with excessive solar %dw", self.evse.charging_rate, excessive)
         else:
-            self.logger.info(f"Excessive solar is not enough: {excessive:,d}w, min: {self.min_excessive_solar:,d}w")
+            self.logger.info("Excessive solar is not enough: %dw, min: %dw", excessive, self.min_excessive_solar)
             self.stop_charger()
         return self.evse.charger_on
 
@@ -141,13 +330,25 @@ class SolarHome:
         """
         self.refresh_charger_status()
         if not self.is_car_connected():
-            self.logger.debug(f"EV charger is not plugged in: {self.evse.icon}.")
-        elif self.refresh_ev_soc() < self.max_soc_on_grid:
-            if self.set_charger(40):
-                self.logger.info(f"Charge at max rate {self.evse.charging_rate}A on grid.")
+            self.logger.debug("EV charger is not plugged in: %s.", self.evse.icon)
+            self.set_state(State.IDLE)
+            return self.evse.charger_on
+
+        try:
+            soc = self.soc.get()
+        except Exception as e:
+            # a failed fetch is not cached, the next tick retries it
+            self.logger.exception(e)
+            soc = self.soc.value
+        if soc is None:
+            self.logger.info("EV SOC is unknown, do not charge on grid.")
+            self.stop_charger()
+        elif soc < self.max_soc_on_grid:
+            if self.set_charger(self.max_charging_rate):
+                self.solar_charging = False
+                self.logger.info("Charge at max rate %dA on grid.", self.evse.charging_rate)
         else:
-            self.logger.info(
-                f"EV SOC is {self.vehicle_soc}%, larger than target {self.max_soc_on_grid}%.")
+            self.logger.info("EV SOC is %d%%, larger than target %d%%.", soc, self.max_soc_on_grid)
             self.stop_charger()
 
         return self.evse.charger_on
@@ -156,121 +357,246 @@ class SolarHome:
         """
         return True if charge state changed, either charge on/off or charge rate change
         """
-        charge_rate = max(min(charge_rate, 40), 6)
+        charge_rate = min(max(charge_rate, self.min_charging_rate), self.max_charging_rate)
         wait = self.charger_protection_wait()
 
         self.refresh_charger_status()
         if not self.evse.charger_on and wait > 0:
-            self.logger.info("Charger protection: wait %d seconds to charge." % wait)
+            self.logger.info("Charger protection: wait %d seconds to charge.", wait)
+            self.set_state(State.WAIT_PROTECTION)
+            return False
+
+        # ignore small rate adjustments while charging
+        if self.evse.charger_on and abs(self.evse.charging_rate - charge_rate) < self.min_charging_rate_delta:
+            self.logger.debug("No change for charging rate @ %dA, target %dA", self.evse.charging_rate, charge_rate)
+            self.cancel_pending_rate()
+            self.set_state(State.CHARGING)
             return False
 
-        if self.evse.charger_on and self.evse.charging_rate == charge_rate:
-            self.logger.debug(f"No change for charging rate @ {charge_rate}A")
+        # coalesce too frequent rate adjustments, only the latest one is written when the window ends
+        since_update = monotonic() - self.last_charger_update
+        if self.evse.charger_on and since_update < self.min_charger_update_interval.total_seconds():
+            self.logger.debug("Defer charging rate change %dA -> %dA", self.evse.charging_rate, charge_rate)
+            self.pending_charging_rate = charge_rate
+            if self.pending_rate_update is None:
+                self.pending_rate_update = self.scheduler.enter(
+                    self.min_charger_update_interval.total_seconds() - since_update, 1, self.flush_charging_rate)
+            self.set_state(State.CHARGING)
             return False
 
+        self.cancel_pending_rate()
         if not self.evse.charger_on:
-            self.last_charging_state_change = datetime.now(tz=self.time_zone)
+            self.last_charging_state_change = monotonic()
         self.evse.charger_on = True
         self.evse.charging_rate = charge_rate
-        self.evse.max_charging_rate = 40
+        self.evse.max_charging_rate = self.max_charging_rate
         self.refresh_charger_status(self.emporia.update_charger(self.evse))
+        self.last_charger_update = monotonic()
+        self.set_state(State.CHARGING if self.evse.charger_on else State.STOPPED)
         return self.evse.charger_on
 
+    def flush_charging_rate(self):
+        self.pending_rate_update = None
+        if self.evse.charger_on:
+            self.run_charger(lambda: self.set_charger(self.pending_charging_rate))
+
+    def cancel_pending_rate(self):
+        if self.pending_rate_update is not None:
+            self.scheduler.cancel(self.pending_rate_update)
+            self.pending_rate_update = None
+
     def charger_protection_wait(self) -> int:
-        interval = datetime.now(tz=self.time_zone) - self.last_charging_state_change
-        return max(0, self.min_charging_state_change_interval.seconds - interval.seconds)
+        interval = monotonic() - self.last_charging_state_change
+        return max(0, int(self.min_charging_state_change_interval.total_seconds() - interval))
 
     def stop_charger(self) -> bool:
         """
         return True if charger stopped
         """
         self.refresh_charger_status()
+        self.cancel_pending_rate()
         wait = self.charger_protection_wait()
         if self.evse.charger_on:
             if wait > 0:
-                self.logger.info(f"Wait {wait} seconds before stop and lower to min charging rate.")
-                self.refresh_charger_status(self.emporia.update_charger(self.evse, charge_rate=6))
+                self.logger.info("Wait %d seconds before stop and lower to min charging rate.", wait)
+                self.refresh_charger_status(self.emporia.update_charger(self.evse, charge_rate=self.min_charging_rate))
+                # still charging, keep polling so it can ramp back up if solar recovers
+                self.set_state(State.STOP_PENDING)
             else:
                 self.evse.charger_on = False
                 self.refresh_charger_status(self.emporia.update_charger(self.evse))
-                self.last_charging_state_change = datetime.now(tz=self.time_zone)
-                self.logger.info(
-                    f"Charging stopped and sleep for {self.min_charging_state_change_interval.seconds} seconds!")
-                sleep(self.min_charging_state_change_interval.seconds)
+                self.last_charging_state_change = monotonic()
+                self.logger.info("Charging stopped, protect charger for %d seconds!",
+                                 self.min_charging_state_change_interval.seconds)
+        if not self.evse.charger_on:
+            self.solar_charging = False
+            self.set_state(State.STOPPED)
         return not self.evse.charger_on
 
+    def set_state(self, state: State):
+        if state != self.state:
+            self.logger.debug("Charging state: %s -> %s", self.state.value, state.value)
+            self.state = state
+            self.poll_level = 0
+
     def is_car_connected(self) -> bool:
         return self.evse.icon == "CarConnected"
 
     def refresh_charger_status(self, evse=None):
         if evse is not None:
+            self.charger.set(evse)
             self.evse = evse
-            self.evse_refresh_time = datetime.now(tz=self.time_zone)
-        elif datetime.now(tz=self.time_zone) - self.evse_refresh_time > self.api_refresh_interval:
-            self.evse = self.emporia.get_chargers()[0]
-            self.logger.debug("refresh charger status.")
-            self.evse_refresh_time = datetime.now(tz=self.time_zone)
-            # fix emporia status when in standby mode
-            if self.is_car_connected() and self.evse.status == 'Standby' and self.evse.charger_on:
-                self.logger.info("Charger is standby and connected, check if car refuse charging.")
-                self.evse.charging_rate = 0
-                self.evse.charger_on = False
-
-    def refresh_ev_soc(self, source="emporia") -> float:
-        if datetime.now(tz=self.time_zone) - self.vehicle_soc_update_time > self.ford.refresh_interval:
-            try:
-                if source == "emporia":
-                    if self.emporia_vehicle is None:
-                        self.emporia_vehicle = self.emporia.get_vehicles()[0]
-                    self.vehicle_soc = self.emporia.get_vehicle_status(self.emporia_vehicle.vehicle_gid).battery_level
-                elif source == "fordpass":
-                    if self.vehicle_id is None:
-                        self.vehicle_id = self.ford.vehicle_ids()[0]["vehicleId"]
-                        self.logger.info("Get vehicle id: %s" % self.vehicle_id)
-                    info = self.ford.vehicle_info(self.vehicle_id)
-                    self.vehicle_soc = info["vehicleDetails"]["batteryChargeLevel"]["value"]
-                self.vehicle_soc_update_time = datetime.now(tz=self.time_zone)
-                self.logger.info("EV SOC @ %d%%" % self.vehicle_soc)
-            except Exception as e:
-                self.logger.exception(e)
-        return self.vehicle_soc
+        elif not self.charger_checked:
+            # status is checked once per tick, later calls in the same tick reuse it
+            self.evse = self.charger.get()
+            self.charger_checked = True
+
+    def fetch_charger(self):
+        evse = self.emporia.get_chargers()[0]
+        self.logger.debug("refresh charger status.")
+        # fix emporia status when in standby mode
+        if evse.icon == "CarConnected" and evse.status == 'Standby' and evse.charger_on:
+            self.logger.info("Charger is standby and connected, check if car refuse charging.")
+            evse.charging_rate = 0
+            evse.charger_on = False
+        return evse
+
+    def fetch_ev_soc(self, source="emporia") -> float:
+        if source == "emporia":
+            if self.emporia_vehicle is None:
+                self.emporia_vehicle = self.emporia.get_vehicles()[0]
+            soc = self.emporia.get_vehicle_status(self.emporia_vehicle.vehicle_gid).battery_level
+        elif source == "fordpass":
+            if self.vehicle_id is None:
+                self.vehicle_id = self.ford.vehicle_ids()[0]["vehicleId"]
+                self.logger.info("Get vehicle id: %s", self.vehicle_id)
+                self.save_vehicle_id()
+            info = self.ford.vehicle_info(self.vehicle_id)
+            soc = info["vehicleDetails"]["batteryChargeLevel"]["value"]
+        else:
+            raise ValueError(f"Unknown EV SOC source: {source}")
+        self.logger.info("EV SOC @ %d%%", soc)
+        return soc
 
     def run_charger(self, charging: ()):
+        self.charger_checked = False
         try:
             charging()
+            self.fail_count = 0
         except Exception as e:
             self.logger.exception(e)
-            self.login_emporia()
-        finally:
-            sleep(15)
+            self.fail_count = min(self.fail_count + 1, 5)
+            self.poll_level = 0
+            # login fails too while emporia is down, the tick backoff retries it
+            try:
+                self.login_emporia()
+            except Exception as e:
+                self.logger.exception(e)
+
+    def poll_interval(self) -> float:
+        interval = self.poll_intervals[self.poll_level]
+        if len(self.excessive_samples) > 1:
+            volatility = statistics.pstdev(self.excessive_samples) / self.volatility_scale
+            interval = max(self.min_poll_interval, interval / (1 + volatility))
+        return interval
+
+    def off_peak_charge(self) -> bool:
+        # charge powerwall battery first then charge the car from grid
+        return self.grid_charge() if not self.solar_charge() and self.battery_power >= 0 else False
+
+    def enter_phase(self, name: str, charging: ()):
+        self.logger.info("Enter %s charging phase.", name)
+        self.charging = charging
+        # evaluate the new phase right away instead of waiting for the next poll
+        if self.next_tick is not None and self.next_tick in self.scheduler.queue:
+            self.scheduler.cancel(self.next_tick)
+        self.next_tick = self.scheduler.enter(0, 1, self.tick)
+
+    def schedule_phases(self):
+        now = monotonic()
+        if now < self.sunrise_deadline:
+            # charge on grid when solar is unavailable
+            self.enter_phase("grid", self.grid_charge)
+        elif now < self.nem_peak_hour_deadline:
+            self.enter_phase("off-peak", self.off_peak_charge)
+        else:
+            self.enter_phase("peak", self.solar_charge)
+        # smart charge on grid or solar during off-peak hours during solar
+        if now < self.sunrise_deadline:
+            self.scheduler.enterabs(self.sunrise_deadline, 0, self.enter_phase, ("off-peak", self.off_peak_charge))
+        # charge on solar during peak hours
+        if now < self.nem_peak_hour_deadline:
+            self.scheduler.enterabs(self.nem_peak_hour_deadline, 0, self.enter_phase, ("peak", self.solar_charge))
+        self.scheduler.enterabs(self.sunset_deadline, 0, self.sunset_stop)
+
+    def tick(self):
+        if monotonic() >= self.sunset_deadline:
+            return
+
+        self.run_charger(self.charging)
+
+        # wake up on protection window expiry or next poll, phase changes wake up on their own
+        now = monotonic()
+        if self.fail_count > 0:
+            # back off with jitter while the APIs keep failing
+            delay = min(self.max_fail_backoff, self.poll_intervals[0] * 2 ** self.fail_count) * random.uniform(0.9, 1.1)
+        elif self.state == State.WAIT_PROTECTION:
+            delay = self.charger_protection_wait()
+        else:
+            delay = self.poll_interval()
+        delay = max(1, delay)
+        self.next_tick = self.scheduler.enter(delay, 1, self.tick)
+        if self.fail_count == 0 and delay > self.prefetch_lead:
+            self.scheduler.enter(delay - self.prefetch_lead, 3, self.prefetch, (now + delay,))
+
+    def prefetch(self, tick_at: float):
+        """
+        refresh in background the readings that will have expired by the next tick
+        """
+        entries = [self.charger]
+        if self.solar_start_deadline <= tick_at < self.solar_end_deadline:
+            entries.append(self.power)
+        for entry in entries:
+            if entry.age() + self.prefetch_lead >= entry.ttl:
+                entry.refresh_async()
+
+    def soc_tick(self):
+        # EV SOC only matters while grid charging is allowed
+        if monotonic() < self.nem_peak_hour_deadline:
+            self.soc.refresh_async()
+            # ahead of the cache ttl so grid_charge never has to wait on it
+            self.scheduler.enter(self.soc.ttl * 0.9, 2, self.soc_tick)
+
+    def sunset_stop(self):
+        self.logger.info("Stop running at sunset time: %s.", self.sunset)
+        for event in self.scheduler.queue:
+            self.scheduler.cancel(event)
+        self.pending_rate_update = None
 
     def run(self):
         self.login_emporia()
         try:
-            # charge on grid when solar is unavailable
-            while datetime.now(tz=self.time_zone) < self.sunrise:
-                self.run_charger(self.grid_charge)
-            # smart charge on grid or solar during off-peak hours during solar
-            while datetime.now(tz=self.time_zone) < self.nem_peak_hour:
-                # charge powerwall battery first then charge the car from grid
-                self.run_charger(
-                    lambda: self.grid_charge() if not self.solar_charge() and self.powerwall.battery >= 0 else False)
-            # charge on solar durin peak hours
-            while datetime.now(tz=self.time_zone) < self.sunset:
-                self.run_charger(self.solar_charge)
-            self.logger.info("Stop running at sunset time: %s." % self.sunset)
+            # one scheduler for all deadlines: charging ticks, phase changes, SOC refresh and sunset
+            self.scheduler.enter(0, 0, self.soc_tick)
+            self.schedule_phases()
+            self.scheduler.run()
         except Exception as e:
             self.logger.exception(e)
         finally:
+            self.charger_checked = False
             self.stop_charger()
+            # background refreshes may still replace the powerwall client and its sessions
+            self.executor.shutdown(wait=True)
+            for session in self.sessions:
+                session.close()
 
 
 if __name__ == "__main__":
     with open("logging_config.json", "r") as f:
-        logging.config.dictConfig(json.load(f))
+        logging.config.dictConfig(orjson.loads(f.read()))
 
     with open("program.json", "r") as f:
-        params = json.load(f)
+        params = orjson.loads(f.read())
 
     home = SolarHome(params=params)
     home.run()